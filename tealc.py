@@ -1,41 +1,71 @@
 #!/usr/bin/env python3
 
 import base64
-import hashlib
-import io
+import functools
 import json
 import logging
 import os
 import re
+import struct
 import sys
 
-import algosdk
-
 logger = logging.getLogger(__name__)
 
+_decode_address = None
+
+def _get_decode_address():
+    # algosdk is slow to import and only needed for addr constants
+    global _decode_address
+    if _decode_address is None:
+        from algosdk.encoding import decode_address
+        _decode_address = decode_address
+    return _decode_address
+
+@functools.lru_cache(maxsize=1)
 def load_langspec():
     with open(os.path.join(os.path.dirname(__file__), 'langspec.json'), 'rt') as fin:
         return json.load(fin)
 
+# ops taking a single one-byte immediate in the range 0..255
+_byte_immediate_ops = ('load', 'store')
+
 def ops_by_name(spec):
-    return {x['Name']:x for x in spec['Ops']}
+    # copies, so derived tables below never leak into the parsed langspec
+    opByName = {x['Name']:dict(x) for x in spec['Ops']}
+    for op in opByName.values():
+        if 'ArgEnum' in op:
+            op['_argIndex'] = {n: i for i, n in enumerate(op['ArgEnum'])}
+            op['_opcodeArgBytes'] = [bytes([op['Opcode'], i]) for i in range(len(op['ArgEnum']))]
+        elif op['Name'] in _byte_immediate_ops:
+            op['_opcodeArgBytes'] = [bytes([op['Opcode'], i]) for i in range(256)]
+    return opByName
+
+_OP_BY_NAME = None
+
+def _get_op_by_name():
+    global _OP_BY_NAME
+    if _OP_BY_NAME is None:
+        _OP_BY_NAME = ops_by_name(load_langspec())
+    return _OP_BY_NAME
+
+_VARUINT_SMALL = [bytes([i]) for i in range(0x80)]
 
 def to_varuint(x):
-    out = []
-    while True:
-        tb = x & 0x7f
-        x = x >> 7
-        if x != 0:
-            tb = tb | 0x80
-        out.append(tb)
-        if x == 0:
-            break
+    if 0 <= x < 0x80:
+        return _VARUINT_SMALL[x]
+    if 0 <= x < 0x4000:
+        return bytes([(x & 0x7f) | 0x80, x >> 7])
+    out = bytearray()
+    while x > 0x7f:
+        out.append((x & 0x7f) | 0x80)
+        x >>= 7
+    out.append(x)
     return bytes(out)
 
-b32re = re.compile(r'b32\((.*?)\)')
-base32re = re.compile(r'base32\((.*?)\)')
-b64re = re.compile(r'b64\((.*?)\)')
-base64re = re.compile(r'base64\((.*?)\)')
+_PREFIX_RE = re.compile(r'(?:b32|base32)\((.*?)\)|(?:b64|base64)\((.*?)\)')
+
+# a comment starts with a '//' token; base64 data may contain '//' mid-token
+_COMMENT_RE = re.compile(r'(?:^|\s)//')
 
 # with padding fixup
 def b32decode(x):
@@ -50,13 +80,13 @@ def parseByteConstant(args):
     if args[0] in ('b64', 'base64'):
         return base64.b64decode(args[1]), args[2:]
     if args[0].startswith('0x'):
-        return base64.b16decode(args[0][2:].upper()), args[1:]
-    m = b32re.match(args[0]) or base32re.match(args[0])
-    if m:
-        return b32decode(m.group(1)), args[1:]
-    m = b64re.match(args[0]) or base64re.match(args[0])
+        return bytes.fromhex(args[0][2:]), args[1:]
+    m = _PREFIX_RE.match(args[0])
     if m:
-        return base64.b64decode(m.group(1)), args[1:]
+        b32, b64 = m.groups()
+        if b32 is not None:
+            return b32decode(b32), args[1:]
+        return base64.b64decode(b64), args[1:]
     raise Exception("could not parse byte constant args {!r}".format(args))
 
 _intc_ops = {
@@ -77,52 +107,80 @@ _arg_ops = {
     2: b'\x2f',
     3: b'\x30',
 }
+def _first_index(values):
+    # map each value to the index of its first occurrence
+    index = {}
+    for i, v in enumerate(values):
+        index.setdefault(v, i)
+    return index
+
+_INTC_TAIL = [bytes([0x21, i]) for i in range(256)]
+_BYTEC_TAIL = [bytes([0x27, i]) for i in range(256)]
+_ARG_TAIL = [bytes([0x2c, i]) for i in range(256)]
+
 class Assembler:
     def __init__(self, sourceName='', version=1):
-        self.out = io.BytesIO()
+        self.out = bytearray()
         self.intc = []
+        self._intc_index = {}
         self.intcWritten = False
         self.bytec = []
+        self._bytec_index = {}
         self.bytecWritten = False
         self.sourceName = sourceName
         self.sourceLine = 0
         self.labels = {}
-        self.labelReferences = []
+        # label -> [(sourceLine, pc), ...] for branches not yet patched
+        self.pendingLabels = {}
         self.spec = load_langspec()
-        self.opByName = ops_by_name(self.spec)
+        self.opByName = _get_op_by_name()
         self.version = 1
+        self.lineHandlers = _get_line_handlers(type(self))
+
+    def _tell(self):
+        return len(self.out)
 
     def setLabel(self, label):
         if label in self.labels:
             raise Exception("duplicate label {!r}".format(label))
-        self.labels[label] = self.out.tell()
+        dest = self._tell()
+        self.labels[label] = dest
+        for sourceLine, pc in self.pendingLabels.pop(label, ()):
+            self.patchJump(sourceLine, pc, label, dest)
 
     def referenceLabel(self, sourceLine, pc, label):
-        self.labelReferences.append( (sourceLine, pc, label) )
+        # backward and too-far jumps fail as their line is assembled, so the
+        # first label error in source order wins over a later undefined label
+        if label in self.labels:
+            raise Exception(":{} label {!r} is before reference but only forward jumps are allowed".format(sourceLine, label))
+        self.pendingLabels.setdefault(label, []).append( (sourceLine, pc) )
+
+    def patchJump(self, sourceLine, pc, label, dest):
+        jump = dest - (pc + 3)
+        if jump > 0x7fff:
+            raise Exception(":{} label {!r} is too far away".format(sourceLine, label))
+        struct.pack_into('>H', self.out, pc + 1, jump)
 
     def write_intc(self, constIndex):
         optimizedOp = _intc_ops.get(constIndex)
         if optimizedOp:
-            self.out.write(optimizedOp)
+            self.out.extend(optimizedOp)
             return
         if constIndex > 0xff:
             raise Exception("cannot have more than 256 int constants")
         if constIndex < 0:
             raise Exception("invalid negative intc const index")
-        self.out.write(bytes([0x21, constIndex]))
+        self.out.extend(_INTC_TAIL[constIndex])
 
     def assemble_int(self, op, args):
         if len(args) != 1:
             raise Exception("int expects 1 arg")
         val = int(args[0], base=0)
-        constIndex = None
-        for i,v in enumerate(self.intc):
-            if v == val:
-                constIndex = i
-                break
+        constIndex = self._intc_index.get(val)
         if constIndex is None:
             constIndex = len(self.intc)
             self.intc.append(val)
+            self._intc_index[val] = constIndex
         self.write_intc(constIndex)
 
     def assemble_intc(self, op, args):
@@ -132,27 +190,27 @@ class Assembler:
         self.write_intc(val)
 
     def write_intcblock(self, out, intc):
-        out.write(b'\x20') # intcblock
-        out.write(to_varuint(len(intc)))
-        for x in intc:
-            out.write(to_varuint(x))
+        parts = [b'\x20', to_varuint(len(intc))] # intcblock
+        parts.extend(map(to_varuint, intc))
+        out.extend(b''.join(parts))
 
     def assemble_intcblock(self, op, args):
         intc = [int(x, base=0) for x in args]
         self.write_intcblock(self.out, intc)
         self.intcWritten = True
         self.intc = intc
+        self._intc_index = _first_index(intc)
 
     def write_bytec(self, constIndex):
         optimizedOp = _bytec_ops.get(constIndex)
         if optimizedOp:
-            self.out.write(optimizedOp)
+            self.out.extend(optimizedOp)
             return
         if constIndex > 0xff:
             raise Exception("cannot have more than 256 byte constants")
         if constIndex < 0:
             raise Exception("invalid negative bytec const index")
-        self.out.write(bytes([0x27, constIndex]))
+        self.out.extend(_BYTEC_TAIL[constIndex])
 
     def assemble_bytec(self, op, args):
         if len(args) != 1:
@@ -161,20 +219,18 @@ class Assembler:
         self.write_bytec(val)
 
     def bytestring(self, val):
-        constIndex = None
-        for i,v in enumerate(self.bytec):
-            if v == val:
-                constIndex = i
-                break
+        val = bytes(val)
+        constIndex = self._bytec_index.get(val)
         if constIndex is None:
             constIndex = len(self.bytec)
             self.bytec.append(val)
+            self._bytec_index[val] = constIndex
         self.write_bytec(constIndex)
 
     def assemble_addr(self, op, args):
         if len(args) != 1:
             raise Exception("addr expects 1 arg")
-        addr = algosdk.encoding.decode_address(args[0])
+        addr = _get_decode_address()(args[0])
         self.bytestring(addr)
 
     def assemble_byte(self, op, args):
@@ -184,11 +240,11 @@ class Assembler:
         self.bytestring(val)
 
     def write_bytecblock(self, out, bytec):
-        out.write(b'\x26') # bytecblock
-        out.write(to_varuint(len(bytec)))
+        parts = [b'\x26', to_varuint(len(bytec))] # bytecblock
         for x in bytec:
-            out.write(to_varuint(len(x)))
-            out.write(x)
+            parts.append(to_varuint(len(x)))
+            parts.append(x)
+        out.extend(b''.join(parts))
 
     def assemble_bytecblock(self, op, args):
         bytec = []
@@ -198,6 +254,7 @@ class Assembler:
         self.write_bytecblock(self.out, bytec)
         self.bytecWritten = True
         self.bytec = bytec
+        self._bytec_index = _first_index(bytec)
 
     def assemble_arg(self, op, args):
         if len(args) != 1:
@@ -205,51 +262,52 @@ class Assembler:
         constIndex = int(args[0])
         optimizedOp = _arg_ops.get(constIndex)
         if optimizedOp:
-            self.out.write(optimizedOp)
+            self.out.extend(optimizedOp)
             return
         if constIndex > 0xff:
             raise Exception("cannot have more than 256 args")
         if constIndex < 0:
             raise Exception("invalid negative arg index")
-        self.out.write(bytes([0x2c, constIndex]))
+        self.out.extend(_ARG_TAIL[constIndex])
 
     def assemble_txn(self, op, args):
         if len(args) != 1:
             raise Exception("{} expects one argument".format(op['Name']))
-        for i, name in enumerate(op['ArgEnum']):
-            if name == args[0]:
-                self.out.write(bytes([op['Opcode'], i]))
-                return
-        raise Exception("{} unknown arg {}".format(op['Name'], args[0]))
+        i = op['_argIndex'].get(args[0])
+        if i is None:
+            raise Exception("{} unknown arg {}".format(op['Name'], args[0]))
+        self.out.extend(op['_opcodeArgBytes'][i])
 
     def assemble_gtxn(self, op, args):
         if len(args) != 2:
             raise Exception("{} expects two arguments".format(op['Name']))
         gtid = int(args[0])
-        for i, name in enumerate(op['ArgEnum']):
-            if name == args[1]:
-                self.out.write(bytes([op['Opcode'], gtid, i]))
-                return
-        raise Exception("{} unknown arg {}".format(op['Name'], args[1]))
+        i = op['_argIndex'].get(args[1])
+        if i is None:
+            raise Exception("{} unknown arg {}".format(op['Name'], args[1]))
+        self.out.append(op['Opcode'])
+        self.out.append(gtid)
+        self.out.append(i)
 
     def assemble_global(self, op, args):
         if len(args) != 1:
             raise Exception("{} expects one argument".format(op['Name']))
-        for i, name in enumerate(op['ArgEnum']):
-            if name == args[0]:
-                self.out.write(bytes([op['Opcode'], i]))
-                return
-        raise Exception("{} unknown arg {}".format(op['Name'], args[0]))
+        i = op['_argIndex'].get(args[0])
+        if i is None:
+            raise Exception("{} unknown arg {}".format(op['Name'], args[0]))
+        self.out.extend(op['_opcodeArgBytes'][i])
 
     def assemble_bnz(self, op, args):
-        self.referenceLabel(self.sourceLine, self.out.tell(), args[0])
-        self.out.write(b'\x40\x00\x00')
+        self.referenceLabel(self.sourceLine, self._tell(), args[0])
+        self.out.extend(b'\x40\x00\x00')
 
     def _load_store(self, op, args):
         if len(args) != 1:
             raise Exception("{} expects 1 arg, got {!r}".format(op['Name'], args))
         arg = int(args[0])
-        self.out.write(bytes([op['Opcode'], arg]))
+        if arg < 0 or arg > 0xff:
+            raise Exception("{} arg out of range 0..255: {}".format(op['Name'], arg))
+        self.out.extend(op['_opcodeArgBytes'][arg])
     def assemble_load(self, op, args):
         self._load_store(op, args)
     def assemble_store(self, op, args):
@@ -258,30 +316,18 @@ class Assembler:
     def assembleLine(self, rawline):
         if not rawline:
             return
-        line = rawline.strip()
-        if not line:
-            return
-        if line.startswith('//'):
-            return
-        parts = line.split()
+        parts = _COMMENT_RE.split(rawline, 1)[0].split()
         if not parts:
-            raise Exception("could not parse line {!r}".format(rawline))
-        newparts = None
-        for i, p in enumerate(parts):
-            if p.startswith('//'):
-                newparts = parts[:i]
-                break
-        if newparts:
-            parts = newparts
-        op = self.opByName.get(parts[0])
-        if op:
-            logging.debug(':%d %06x op %02x %s', self.sourceLine, self.out.tell(), op['Opcode'], op['Name'])
-        fn = getattr(self, 'assemble_' + parts[0], None)
-        if fn is not None:
-            fn(op, parts[1:])
             return
-        if op is not None:
-            self.out.write(bytes([op['Opcode']]))
+        handler = self.lineHandlers.get(parts[0])
+        if handler is not None:
+            fn, op = handler
+            if op is not None and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(':%d %06x op %02x %s', self.sourceLine, self._tell(), op['Opcode'], op['Name'])
+            if fn is _opcode_only:
+                self.out.append(op['Opcode'])
+            else:
+                fn(self, op, parts[1:])
             return
         if parts[0].endswith(':'):
             self.setLabel(parts[0][:len(parts[0])-1])
@@ -294,34 +340,45 @@ class Assembler:
             self.assembleLine(line)
 
     def resolveLabels(self):
-        if not self.labelReferences:
-            return self.out.getvalue()
-        program = self.out.getbuffer()
-        for sourceLine, pc, label in self.labelReferences:
-            dest = self.labels.get(label)
-            if dest is None:
-                raise Exception(":{} reference to undefined label {!r}".format(sourceLine, label))
-            nextPc = pc + 3
-            if dest < nextPc:
-                raise Exception(":{} label {!r} is before reference but only forward jumps are allowed".format(sourceLine, label))
-            jump = dest - nextPc
-            if jump > 0x7fff:
-                raise Exception(":{} label {!r} is too far away".format(sourceLine, label))
-            program[pc + 1] = jump >> 8
-            program[pc + 2] = jump & 0x0ff
-        return program
+        # jumps are patched as their labels are set; anything left is undefined
+        if self.pendingLabels:
+            label, refs = next(iter(self.pendingLabels.items()))
+            sourceLine, _ = refs[0]
+            raise Exception(":{} reference to undefined label {!r}".format(sourceLine, label))
+        return self.out
 
     def getBytes(self):
-        prefix = io.BytesIO()
-        prefix.write(to_varuint(self.version))
+        header = bytearray(to_varuint(self.version))
         if self.intc and not self.intcWritten:
-            self.write_intcblock(prefix, self.intc)
+            self.write_intcblock(header, self.intc)
             self.intcWritten = True
         if self.bytec and not self.bytecWritten:
-            self.write_bytecblock(prefix, self.bytec)
+            self.write_bytecblock(header, self.bytec)
             self.bytecWritten = True
-        prefix.write(self.resolveLabels())
-        return prefix.getvalue()
+        # one copy of the program body, straight into the result
+        return b''.join((header, self.resolveLabels()))
+
+# marks ops that assemble to just their opcode byte
+_opcode_only = object()
+
+# Assembler class -> {name: (assemble_* function or _opcode_only, op)}
+_LINE_HANDLERS = {}
+
+def _get_line_handlers(cls):
+    # built once per class so subclasses can override or add assemble_* methods
+    handlers = _LINE_HANDLERS.get(cls)
+    if handlers is None:
+        handlers = {}
+        for name, op in _get_op_by_name().items():
+            handlers[name] = (getattr(cls, 'assemble_' + name, _opcode_only), op)
+        # pseudo-ops such as int/byte/addr are not in the langspec
+        for attr in dir(cls):
+            if attr.startswith('assemble_'):
+                name = attr[len('assemble_'):]
+                if name not in handlers:
+                    handlers[name] = (getattr(cls, attr), None)
+        _LINE_HANDLERS[cls] = handlers
+    return handlers
 
 def AssembleString(text):
     a = Assembler()
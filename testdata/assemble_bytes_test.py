@@ -26,7 +26,7 @@ byteConstantVariations = [
 ]
 
 hexresult = "0126010661626364656628"
-result = base64.b16decode(hexresult)
+result = bytes.fromhex(hexresult)
 
 retcode = 0
 
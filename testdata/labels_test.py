@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tealc
+
+retcode = 0
+
+# two references to 'a' patched by one label, plus a second label
+forwardSource = "int 1\nbnz a\nbnz a\nbnz b\nint 2\na:\nint 3\nb:\nint 1\n"
+forwardResult = "01200301020322400007400004400002232422"
+
+prog = tealc.AssembleString(forwardSource)
+if prog.hex() != forwardResult:
+    sys.stderr.write("FAIL: {!r}, wanted {} got {}\n".format(forwardSource, forwardResult, prog.hex()))
+    retcode = 1
+
+errorVariations = [
+    ("a:\nint 1\nbnz a", ":3 label 'a' is before reference but only forward jumps are allowed"),
+    ("int 1\nbnz nowhere", ":2 reference to undefined label 'nowhere'"),
+    ("int 1\nbnz far\n" + ("err\n" * 0x8000) + "far:", ":2 label 'far' is too far away"),
+    # the first error in source order wins over an undefined label reported at the end
+    ("int 1\nbnz nowhere\nb:\nbnz b", ":4 label 'b' is before reference but only forward jumps are allowed"),
+]
+
+for text, wanted in errorVariations:
+    try:
+        tealc.AssembleString(text)
+        got = None
+    except Exception as e:
+        got = str(e)
+    if got != wanted:
+        sys.stderr.write("FAIL: {!r}, wanted error {!r} got {!r}\n".format(text[:40], wanted, got))
+        retcode = 1
+sys.exit(retcode)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tealc
+
+# every line boundary str.splitlines() recognizes
+separators = ['\n', '\r', '\r\n', '\v', '\f', '\x1c', '\x1d', '\x1e', '\x85', '\u2028', '\u2029']
+
+hexresult = "012002010222230808"
+result = bytes.fromhex(hexresult)
+
+retcode = 0
+
+for sep in separators:
+    text = sep.join(["int 1", "int 2", "+", "+"])
+    prog = tealc.AssembleString(text)
+    if prog != result:
+        sys.stderr.write("FAIL: {!r}, wanted {} got {}\n".format(text, hexresult, prog.hex()))
+        retcode = 1
+
+# one very long line must not cost more than a linear scan; a splitter that
+# re-scans the carried-over line per block took >10s here
+text = "int 1\n// " + ("x" * (32 << 20)) + "\n+\n+"
+start = time.perf_counter()
+prog = tealc.AssembleString(text)
+elapsed = time.perf_counter() - start
+if prog != bytes.fromhex("01200101220808") or elapsed > 2.0:
+    sys.stderr.write("FAIL: long line, got {} in {:.2f}s\n".format(prog.hex(), elapsed))
+    retcode = 1
+sys.exit(retcode)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tealc
+
+class CustomAssembler(tealc.Assembler):
+    # override a real opcode
+    def assemble_pop(self, op, args):
+        self.assembleLine('err')
+
+    # add a new pseudo-op
+    def assemble_twice(self, op, args):
+        self.assembleLine(' '.join(args))
+        self.assembleLine(' '.join(args))
+
+retcode = 0
+
+variations = [
+    (tealc.Assembler, "int 1\npop", "012001012248"),
+    (CustomAssembler, "int 1\npop", "012001012200"),
+    (CustomAssembler, "twice int 1\n+", "01200101222208"),
+    (tealc.Assembler, "int 1\npop", "012001012248"),
+]
+
+for cls, text, wanted in variations:
+    a = cls()
+    a.assembleLineSource(text.splitlines())
+    prog = a.getBytes()
+    if prog.hex() != wanted:
+        sys.stderr.write("FAIL: {} {!r}, wanted {} got {}\n".format(cls.__name__, text, wanted, prog.hex()))
+        retcode = 1
+sys.exit(retcode)
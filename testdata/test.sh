@@ -10,3 +10,6 @@ for i in *.teal; do
 done
 
 python3 assemble_bytes_test.py
+python3 labels_test.py
+python3 lines_test.py
+python3 subclass_test.py